@@ -296,6 +296,8 @@ public:
 
 #ifdef NGP_PYTHON
 	pybind11::array_t<float> render_to_cpu(int width, int height, int spp, bool linear, float start_t, float end_t, float fps, float shutter_fraction);
+	void render_batch_into(pybind11::array_t<float> out, pybind11::array_t<float, pybind11::array::c_style | pybind11::array::forcecast> camera_matrices, int spp, bool linear);
+	pybind11::array_t<float> render_batch_to_cpu(pybind11::array_t<float, pybind11::array::c_style | pybind11::array::forcecast> camera_matrices, int width, int height, int spp, bool linear);
 	pybind11::array_t<float> screenshot(bool linear) const;
 	void override_sdf_training_data(pybind11::array_t<float> points, pybind11::array_t<float> distances);
 #endif
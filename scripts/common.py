@@ -20,6 +20,9 @@ from scipy.ndimage.filters import convolve1d
 import glob
 import struct
 import io
+import re
+import commentjson
+import orjson
 
 import PIL.Image
 PIL.Image.MAX_IMAGE_PIXELS = 10000000000
@@ -48,6 +51,19 @@ VOLUME_DATA_FOLDER = os.path.join(NGP_DATA_FOLDER, "volume")
 sys.path += [os.path.dirname(pyd) for pyd in glob.iglob(os.path.join(ROOT_DIR, "build*", "**/*.pyd"), recursive=True)]
 sys.path += [os.path.dirname(pyd) for pyd in glob.iglob(os.path.join(ROOT_DIR, "build*", "**/*.so"), recursive=True)]
 
+# Matches whole-line // and # comments. Trailing comments after a value are not matched.
+JSON_COMMENT_RE = re.compile(rb"^\s*(//|#).*$", re.MULTILINE)
+
+def read_json(file):
+	# Fast path via orjson. Files it rejects (e.g. trailing comments or NaN/Infinity values)
+	# are parsed with the slower but more lenient commentjson instead.
+	with open(file, "rb") as f:
+		data = f.read()
+	try:
+		return orjson.loads(JSON_COMMENT_RE.sub(b"", data))
+	except orjson.JSONDecodeError:
+		return commentjson.loads(data.decode("utf-8"))
+
 def repl(testbed):
 	print("-------------------\npress Ctrl-Z to return to gui\n---------------------------")
 	code.InteractiveConsole(locals=locals()).interact()
@@ -150,6 +166,41 @@ def linear_to_srgb(img):
 	limit = 0.0031308
 	return np.where(img > limit, 1.055 * (img ** (1.0 / 2.4)) - 0.055, 12.92 * img)
 
+# 16 bit lookup tables that replace the per-pixel pow() of the above conversions for values in [0,1]
+LINEAR_TO_SRGB_LUT = linear_to_srgb(np.linspace(0.0, 1.0, 65536, dtype=np.float32))
+SRGB_TO_LINEAR_LUT = srgb_to_linear(np.linspace(0.0, 1.0, 65536, dtype=np.float32))
+
+def apply_lut(lut, img):
+	idx = np.clip(img, 0.0, 1.0) * (len(lut) - 1) + 0.5
+	return lut[idx.astype(np.uint16)]
+
+# Inputs outside of [0,1] are clamped, so only use these when the image is known to be in range.
+def srgb_to_linear_lut(img):
+	return apply_lut(SRGB_TO_LINEAR_LUT, img)
+
+def linear_to_srgb_lut(img):
+	return apply_lut(LINEAR_TO_SRGB_LUT, img)
+
+def composite_and_mse(img, ref, ldr=True):
+	# Composites the alpha-premultiplied linear `img` onto opaque white in sRGB space, leaving the
+	# sRGB result in `img`, and returns its MSE w.r.t. the white-composited linear `ref` in sRGB space.
+	# Like compute_error("MSE", ...), non-finite and negative image values are treated as 0, but this
+	# is done on the rendered linear values (before the LUT and compositing) rather than on the sRGB
+	# result, so a NaN pixel (or alpha) is composited like a transparent one. Non-finite differences,
+	# which can only stem from `ref`, contribute no error. Pass `ldr=False` for HDR scenes, whose
+	# rendered colors may exceed 1 and thus must not go through the (clamping) LUT.
+	np.nan_to_num(img, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+	srgb = img[...,:3]
+	np.maximum(srgb, 0.0, out=srgb)
+	srgb[...] = linear_to_srgb_lut(srgb) if ldr else linear_to_srgb(srgb)
+	srgb += 1.0 - img[...,3:4]
+	img[...,3] = 1.0
+
+	diff = srgb - linear_to_srgb(ref[...,:3])
+	diff[np.logical_not(np.isfinite(diff))] = 0
+	np.square(diff, out=diff)
+	return float(np.mean(diff))
+
 def read_image(file):
 	if os.path.splitext(file)[1] == ".exr":
 		img = exr.read(file).astype(np.float32)
@@ -159,13 +210,14 @@ def read_image(file):
 			h, w = struct.unpack("ii", bytes[:8])
 			img = np.frombuffer(bytes, dtype=np.float16, count=h*w*4, offset=8).astype(np.float32).reshape([h, w, 4])
 	else:
+		# 8 bit values map exactly onto entries of the 16 bit LUT
 		img = read_image_pillow(file)
 		if img.shape[2] == 4:
-			img[...,0:3] = srgb_to_linear(img[...,0:3])
+			img[...,0:3] = srgb_to_linear_lut(img[...,0:3])
 			# Premultiply alpha
 			img[...,0:3] *= img[...,3:4]
 		else:
-			img = srgb_to_linear(img)
+			img = srgb_to_linear_lut(img)
 	return img
 
 def write_image(file, img, quality=95):
@@ -9,8 +9,10 @@
 # license agreement from NVIDIA CORPORATION is strictly prohibited.
 
 import argparse
+import math
 import os
-import commentjson as json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
@@ -117,15 +119,15 @@ if __name__ == "__main__":
 	ref_transforms = {}
 	if args.screenshot_transforms: # try to load the given file straight away
 		print("screenshot transforms from ", args.screenshot_transforms)
-		with open(args.screenshot_transforms) as f:
-			ref_transforms = json.load(f)
+		ref_transforms = read_json(args.screenshot_transforms)
 
 	if args.gui:
 		sw=args.screenshot_w or 1920
 		sh=args.screenshot_h or 1080
-		while sw*sh > 1920*1080*4:
-			sw = int(sw / 2)
-			sh = int(sh / 2)
+		# Keep the window at most 4x the pixels of 1080p
+		scale = max(1.0, math.sqrt(sw*sh / (1920*1080*4)))
+		sw = int(sw / scale)
+		sh = int(sh / scale)
 		testbed.init_window(sw, sh)
 
 	testbed.shall_train = args.train if args.gui else True
@@ -144,14 +146,18 @@ if __name__ == "__main__":
 		print(f"NeRF compatibility mode enabled")
 
 	old_training_step = 0
+	tqdm_last_update = 0.0
 	n_steps = args.n_steps
 	if n_steps < 0:
 		n_steps = 100000
 
+	# The repl can only be requested through the GUI and needs an interactive terminal
+	repl_possible = args.gui and sys.stdin.isatty()
+
 	if n_steps > 0:
 		with tqdm(desc="Training", total=n_steps, unit="step") as t:
 			while testbed.frame():
-				if testbed.want_repl():
+				if repl_possible and testbed.want_repl():
 					repl(testbed)
 				# What will happen when training is done?
 				if testbed.training_step >= n_steps:
@@ -162,12 +168,21 @@ if __name__ == "__main__":
 
 				# Update progress bar
 				if testbed.training_step < old_training_step or old_training_step == 0:
-					old_training_step = 0
 					t.reset()
+					t.update(testbed.training_step)
+					old_training_step = testbed.training_step
+
+				# Formatting the progress bar is comparatively slow, so only refresh it every 100ms
+				now = time.monotonic()
+				if now - tqdm_last_update > 0.1:
+					t.update(testbed.training_step - old_training_step)
+					t.set_postfix(loss=testbed.loss)
+					old_training_step = testbed.training_step
+					tqdm_last_update = now
 
-				t.update(testbed.training_step - old_training_step)
-				t.set_postfix(loss=testbed.loss)
-				old_training_step = testbed.training_step
+			# Flush the steps accumulated since the last refresh
+			t.update(testbed.training_step - old_training_step)
+			t.set_postfix(loss=testbed.loss)
 
 	if args.save_snapshot:
 		print("saving snapshot ", args.save_snapshot)
@@ -175,15 +190,10 @@ if __name__ == "__main__":
 
 	if args.test_transforms:
 		print("test transforms from ", args.test_transforms)
-		with open(args.test_transforms) as f:
-			test_transforms = json.load(f)
+		test_transforms = read_json(args.test_transforms)
 		data_dir=os.path.dirname(args.test_transforms)
-		totmse = 0
 		totpsnr = 0
 		totssim = 0
-		totcount = 0
-		minpsnr = 1000
-		maxpsnr = 0
 
 		spp = 8
 		testbed.background_color = [0.0, 0.0, 0.0, 0.0]
@@ -192,56 +202,111 @@ if __name__ == "__main__":
 		testbed.fov_axis = 0
 		testbed.fov = test_transforms["camera_angle_x"] * 180 / np.pi
 		testbed.shall_train = False
-		with tqdm(list(enumerate(test_transforms["frames"])), unit="images", desc=f"Rendering test frame") as t:
-			for i, frame in t:
-				p = frame["file_path"]
-				if "." not in p:
-					p = p + ".png"
-				ref_fname = os.path.join(data_dir, p)
-				if not os.path.isfile(ref_fname):
-					ref_fname = os.path.join(data_dir, p + ".png")
-					if not os.path.isfile(ref_fname):
-						ref_fname = os.path.join(data_dir, p + ".jpg")
-						if not os.path.isfile(ref_fname):
-							ref_fname = os.path.join(data_dir, p + ".jpeg")
-							if not os.path.isfile(ref_fname):
-								ref_fname = os.path.join(data_dir, p + ".exr")
-				ref_image = read_image(ref_fname)
-				ref_image += (1.0 - ref_image[...,3:4]) # composite ref on opaque white in linear land
-				if i == 0:
-					write_image("ref.png", ref_image)
-
-				testbed.set_nerf_camera_matrix(np.matrix(frame["transform_matrix"])[:-1,:])
-				image = testbed.render(ref_image.shape[1], ref_image.shape[0], spp, True)
-				image[...,:3] = linear_to_srgb(image[...,:3])
-				image += (1.0 - image[...,3:4]) # composite on opaque white in SRGB land
-				image[...,:3] = srgb_to_linear(image[...,:3])
-				if i == 0:
-					write_image("out.png", image)
-
-				diffimg = np.absolute(image - ref_image)
-				diffimg[...,3:4] = 1.0
-				if i == 0:
-					write_image("diff.png", diffimg)
-
-				A = linear_to_srgb(image[...,:3])
-				R = linear_to_srgb(ref_image[...,:3])
-				mse = float(compute_error("MSE",A,R))
-				ssim = 0 # float(compute_error("SSIM",A,R))
-				totssim += ssim
-				totmse += mse
-				psnr = mse2psnr(mse)
-				totpsnr += psnr
-				minpsnr = psnr if psnr<minpsnr else minpsnr
-				maxpsnr = psnr if psnr>maxpsnr else maxpsnr
-				totcount = totcount+1
-				t.set_postfix(psnr = totpsnr/(totcount or 1))
-
-
-		psnr_avgmse = mse2psnr(totmse/(totcount or 1))
-		psnr = totpsnr/(totcount or 1)
-		ssim = totssim/(totcount or 1)
-		print(f"psnr {psnr} average, psnr range {minpsnr}-{maxpsnr}, ssim {ssim}")
+		# HDR scenes use an exponential color activation, so rendered colors are not limited to [0,1]
+		is_hdr = testbed.nerf.training.dataset.is_hdr
+		frames = test_transforms["frames"]
+		n_frames = len(frames)
+		mses = np.empty(n_frames, dtype=np.float64)
+		# Gather all camera matrices into one contiguous (N,3,4) array up front, such that
+		# each batch is a contiguous view that render_batch_into() can read without a copy
+		cam_matrices = np.ascontiguousarray(np.asarray([frame["transform_matrix"] for frame in frames], dtype=np.float32).reshape(-1, 4, 4)[:, :3, :])
+
+		# List each image directory once rather than probing every candidate extension with a stat() call.
+		# Names are lower-cased on Windows and macOS, whose file systems (and thus isfile()) are case-insensitive.
+		ignore_case = os.name == "nt" or sys.platform == "darwin"
+		def file_key(name):
+			return name.lower() if ignore_case else name
+
+		dir_files = {}
+		ref_fnames = []
+		for frame in frames:
+			p = frame["file_path"]
+			if "." not in p:
+				p = p + ".png"
+			ref_dir, ref_name = os.path.split(os.path.normpath(os.path.join(data_dir, p)))
+			if ref_dir not in dir_files:
+				with os.scandir(ref_dir or ".") as it:
+					dir_files[ref_dir] = {file_key(entry.name) for entry in it if entry.is_file()}
+			ref_fname = os.path.join(ref_dir, ref_name + ".exr")
+			for ext in ("", ".png", ".jpg", ".jpeg"):
+				if file_key(ref_name + ext) in dir_files[ref_dir]:
+					ref_fname = os.path.join(ref_dir, ref_name + ext)
+					break
+			ref_fnames.append(ref_fname)
+
+		# EXRs are decoded by pyngp, which releases the GIL such that several of them can be decoded in parallel.
+		# tinyexr does not support every compression scheme (e.g. B44, DWA, PXR24); those files go through pyexr.
+		def read_ref_image(fname):
+			if os.path.splitext(fname)[1] == ".exr":
+				try:
+					return ngp.load_exr(fname)
+				except RuntimeError:
+					pass
+			return read_image(fname)
+
+		with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor, tqdm(total=n_frames, unit="images", desc=f"Rendering test frame") as t:
+			ref_futures = deque(executor.submit(read_ref_image, fname) for fname in ref_fnames[:1])
+
+			# Test sets generally share one resolution, so fix it once up front
+			h, w = ref_futures[0].result().shape[:2] if ref_futures else (0, 0)
+
+			# Each frame of a batch holds a rendered image, its reference and a prefetched reference
+			# (all RGBA float32), so size batches to stay within a fixed memory budget.
+			test_memory_budget = 1 << 30
+			batch_size = max(1, min(16, test_memory_budget // (3 * h * w * 16 or 1)))
+
+			# Decode reference images in the background while the GPU renders. One batch worth of
+			# images is kept in flight, such that the next batch is ready when the current one is done.
+			n_prefetch = batch_size
+			ref_futures.extend(executor.submit(read_ref_image, fname) for fname in ref_fnames[1:n_prefetch])
+
+			# Every batch is rendered into the same buffer rather than allocating new images
+			out_images = np.empty((batch_size, h, w, 4), dtype=np.float32)
+			for batch_start in range(0, n_frames, batch_size):
+				cams = cam_matrices[batch_start:batch_start+batch_size]
+				ref_images = []
+				for _ in cams:
+					ref_images.append(ref_futures.popleft().result())
+					next_ref = batch_start + len(ref_images) - 1 + n_prefetch
+					if next_ref < len(ref_fnames):
+						ref_futures.append(executor.submit(read_ref_image, ref_fnames[next_ref]))
+
+				# Render the whole batch in one call if all reference images have the common resolution
+				if all(ref_image.shape[:2] == (h, w) for ref_image in ref_images):
+					images = out_images[:len(cams)]
+					testbed.render_batch_into(images, cams, spp, True)
+				else:
+					images = []
+					for cam, ref_image in zip(cams, ref_images):
+						testbed.set_nerf_camera_matrix(cam)
+						images.append(testbed.render(ref_image.shape[1], ref_image.shape[0], spp, True))
+
+				for i, (ref_image, image) in enumerate(zip(ref_images, images), start=batch_start):
+					ref_image += (1.0 - ref_image[...,3:4]) # composite ref on opaque white in linear land
+					if i == 0:
+						write_image("ref.png", ref_image)
+
+					mse = composite_and_mse(image, ref_image, ldr=not is_hdr) # composite on opaque white in SRGB land
+					if i == 0:
+						image[...,:3] = srgb_to_linear(image[...,:3])
+						write_image("out.png", image)
+
+						diffimg = np.absolute(image - ref_image)
+						diffimg[...,3:4] = 1.0
+						write_image("diff.png", diffimg)
+
+					ssim = 0 # float(compute_error("SSIM",image[...,:3],linear_to_srgb(ref_image[...,:3])))
+					totssim += ssim
+					mses[i] = mse
+					totpsnr += mse2psnr(mse)
+					t.update()
+					t.set_postfix(psnr = totpsnr/(i+1))
+
+		if n_frames > 0:
+			psnrs = mse2psnr(mses)
+			psnr_avgmse = mse2psnr(mses.mean())
+			ssim = totssim/n_frames
+			print(f"psnr {psnrs.mean()} average, psnr range {psnrs.min()}-{psnrs.max()}, psnr median {np.median(psnrs)}, ssim {ssim}")
 
 	if args.screenshot_w:
 		if ref_transforms:
@@ -250,16 +315,28 @@ if __name__ == "__main__":
 			if not len(args.screenshot_frames):
 				args.screenshot_frames = range(len(ref_transforms))
 			print(args.screenshot_frames)
-			for idx in args.screenshot_frames:
-				f = ref_transforms["frames"][int(idx)]
-				print(f)
-				cam_matrix = f["transform_matrix"]
-				testbed.set_nerf_camera_matrix(np.matrix(cam_matrix)[:-1,:])
-				outname = os.path.join(args.screenshot_dir, os.path.basename(f["file_path"]))
-				print(f"rendering {outname}")
-				image = testbed.render(args.screenshot_w or int(ref_transforms["w"]), args.screenshot_h or int(ref_transforms["h"]), args.screenshot_spp, True)
-				os.makedirs(os.path.dirname(outname), exist_ok=True)
-				write_image(outname, image)
+			# Encode and write screenshots on a thread pool while the next one renders. Pillow releases
+			# the GIL while compressing, so several images are encoded in parallel. Each pending write
+			# holds a full-resolution float image, so only a few are allowed in flight.
+			n_writers = min(4, os.cpu_count() or 1)
+			pending_writes = deque()
+			with ThreadPoolExecutor(max_workers=n_writers) as executor:
+				for idx in args.screenshot_frames:
+					f = ref_transforms["frames"][int(idx)]
+					print(f)
+					cam_matrix = f["transform_matrix"]
+					testbed.set_nerf_camera_matrix(np.asarray(cam_matrix, dtype=np.float32)[:3,:])
+					outname = os.path.join(args.screenshot_dir, os.path.basename(f["file_path"]))
+					print(f"rendering {outname}")
+					image = testbed.render(args.screenshot_w or int(ref_transforms["w"]), args.screenshot_h or int(ref_transforms["h"]), args.screenshot_spp, True)
+					os.makedirs(os.path.dirname(outname), exist_ok=True)
+					if len(pending_writes) >= n_writers:
+						pending_writes.popleft().result()
+					pending_writes.append(executor.submit(write_image, outname, image))
+
+				# Surface any errors that occurred while writing
+				for write in pending_writes:
+					write.result()
 		else:
 			outname = os.path.join(args.screenshot_dir, args.scene + "_" + network_stem)
 			print(f"rendering {outname}.png")
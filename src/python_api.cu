@@ -14,6 +14,7 @@
 
 #include <neural-graphics-primitives/testbed.h>
 #include <neural-graphics-primitives/thread_pool.h>
+#include <neural-graphics-primitives/tinyexr_wrapper.h>
 
 #include <json/json.hpp>
 
@@ -73,50 +74,108 @@ void Testbed::override_sdf_training_data(py::array_t<float> points, py::array_t<
 }
 
 py::array_t<float> Testbed::render_to_cpu(int width, int height, int spp, bool linear, float start_time, float end_time, float fps, float shutter_fraction) {
-	m_windowless_render_surface.resize({width, height});
-	m_windowless_render_surface.reset_accumulation();
+	py::array_t<float> result({height, width, 4});
+	py::buffer_info buf = result.request();
+
+	// Rendering does not touch any Python state, so let other threads (e.g. image writers) run in the meantime.
+	{
+		py::gil_scoped_release release;
+
+		m_windowless_render_surface.resize({width, height});
+		m_windowless_render_surface.reset_accumulation();
+
+		if (end_time < 0.f) {
+			end_time = start_time;
+		}
+
+		auto start_cam_matrix = m_smoothed_camera;
+
+		if (start_time >= 0.f) {
+			set_camera_from_time(end_time);
+			apply_camera_smoothing(1000.f / fps);
+		} else {
+			start_cam_matrix = m_smoothed_camera = m_camera;
+		}
+
+		auto end_cam_matrix = m_smoothed_camera;
+
+		for (int i = 0; i < spp; ++i) {
+			float start_alpha = ((float)i)/(float)spp * shutter_fraction;
+			float end_alpha = ((float)i + 1.0f)/(float)spp * shutter_fraction;
+
+			auto sample_start_cam_matrix = log_space_lerp(start_cam_matrix, end_cam_matrix, start_alpha);
+			auto sample_end_cam_matrix = log_space_lerp(start_cam_matrix, end_cam_matrix, end_alpha);
+
+			if (start_time >= 0.f) {
+				set_camera_from_time(start_time + (end_time-start_time) * (start_alpha + end_alpha) / 2.0f);
+				m_smoothed_camera = m_camera;
+			}
 
-	if (end_time < 0.f) {
-		end_time = start_time;
+			if (m_autofocus) {
+				autofocus();
+			}
+
+			render_frame(sample_start_cam_matrix, sample_end_cam_matrix, m_windowless_render_surface, !linear);
+		}
+
+		// For cam smoothing when rendering the next frame.
+		m_smoothed_camera = end_cam_matrix;
+
+		CUDA_CHECK_THROW(cudaMemcpy2DFromArray(buf.ptr, width * sizeof(float) * 4, m_windowless_render_surface.surface_provider().array(), 0, 0, width * sizeof(float) * 4, height, cudaMemcpyDeviceToHost));
 	}
 
-	auto start_cam_matrix = m_smoothed_camera;
+	return result;
+}
+
+void Testbed::render_batch_into(py::array_t<float> out, py::array_t<float, py::array::c_style | py::array::forcecast> camera_matrices, int spp, bool linear) {
+	py::buffer_info cams_buf = camera_matrices.request();
+	if (cams_buf.ndim != 3 || cams_buf.shape[1] != 3 || cams_buf.shape[2] != 4) {
+		throw std::runtime_error{"Camera matrices must have shape (N,3,4)"};
+	}
 
-	if (start_time >= 0.f) {
-		set_camera_from_time(end_time);
-		apply_camera_smoothing(1000.f / fps);
-	} else {
-		start_cam_matrix = m_smoothed_camera = m_camera;
+	py::buffer_info buf = out.request(true);
+	if (!(out.flags() & py::array::c_style) || buf.ndim != 4 || buf.shape[0] != cams_buf.shape[0] || buf.shape[3] != 4) {
+		throw std::runtime_error{"Output array must be C-contiguous with shape (N,height,width,4)"};
 	}
 
-	auto end_cam_matrix = m_smoothed_camera;
+	int n_cams = (int)cams_buf.shape[0];
+	int height = (int)buf.shape[1];
+	int width = (int)buf.shape[2];
+	const float* cams = (const float*)cams_buf.ptr;
+	float* data = (float*)buf.ptr;
 
-	for (int i = 0; i < spp; ++i) {
-		float start_alpha = ((float)i)/(float)spp * shutter_fraction;
-		float end_alpha = ((float)i + 1.0f)/(float)spp * shutter_fraction;
+	// Rendering does not touch any Python state, so let other threads (e.g. image loaders) run in the meantime.
+	py::gil_scoped_release release;
 
-		auto sample_start_cam_matrix = log_space_lerp(start_cam_matrix, end_cam_matrix, start_alpha);
-		auto sample_end_cam_matrix = log_space_lerp(start_cam_matrix, end_cam_matrix, end_alpha);
+	// All views share the same render surface and stream. The output buffer is pageable memory, so each
+	// copy below still blocks the host; batching mainly saves the per-call overhead of rendering from Python.
+	m_windowless_render_surface.resize({width, height});
+	for (int i = 0; i < n_cams; ++i) {
+		set_nerf_camera_matrix(Map<const Matrix<float, 3, 4, RowMajor>>(cams + i * 12));
+		m_smoothed_camera = m_camera;
+		m_windowless_render_surface.reset_accumulation();
 
-		if (start_time >= 0.f) {
-			set_camera_from_time(start_time + (end_time-start_time) * (start_alpha + end_alpha) / 2.0f);
-			m_smoothed_camera = m_camera;
-		}
+		for (int j = 0; j < spp; ++j) {
+			if (m_autofocus) {
+				autofocus();
+			}
 
-		if (m_autofocus) {
-			autofocus();
+			render_frame(m_smoothed_camera, m_smoothed_camera, m_windowless_render_surface, !linear);
 		}
 
-		render_frame(sample_start_cam_matrix, sample_end_cam_matrix, m_windowless_render_surface, !linear);
+		CUDA_CHECK_THROW(cudaMemcpy2DFromArrayAsync(data + (size_t)i * height * width * 4, width * sizeof(float) * 4, m_windowless_render_surface.surface_provider().array(), 0, 0, width * sizeof(float) * 4, height, cudaMemcpyDeviceToHost, m_inference_stream));
 	}
 
-	// For cam smoothing when rendering the next frame.
-	m_smoothed_camera = end_cam_matrix;
+	CUDA_CHECK_THROW(cudaStreamSynchronize(m_inference_stream));
+}
 
-	py::array_t<float> result({height, width, 4});
-	py::buffer_info buf = result.request();
+py::array_t<float> Testbed::render_batch_to_cpu(py::array_t<float, py::array::c_style | py::array::forcecast> camera_matrices, int width, int height, int spp, bool linear) {
+	if (camera_matrices.ndim() != 3 || camera_matrices.shape(1) != 3 || camera_matrices.shape(2) != 4) {
+		throw std::runtime_error{"Camera matrices must have shape (N,3,4)"};
+	}
 
-	CUDA_CHECK_THROW(cudaMemcpy2DFromArray(buf.ptr, width * sizeof(float) * 4, m_windowless_render_surface.surface_provider().array(), 0, 0, width * sizeof(float) * 4, height, cudaMemcpyDeviceToHost));
+	py::array_t<float> result({(int)camera_matrices.shape(0), height, width, 4});
+	render_batch_into(result, camera_matrices, spp, linear);
 	return result;
 }
 
@@ -146,6 +205,23 @@ py::array_t<float> Testbed::screenshot(bool linear) const {
 	return result;
 }
 
+py::array_t<float> load_exr_to_cpu(const std::string& path) {
+	float* data;
+	int width, height;
+
+	{
+		// Decoding does not touch any Python state, so let other threads run in the meantime.
+		py::gil_scoped_release release;
+		load_exr(&data, &width, &height, path.c_str());
+	}
+
+	py::array_t<float> result({height, width, 4});
+	py::buffer_info buf = result.request();
+	std::memcpy(buf.ptr, data, (size_t)width * height * 4 * sizeof(float));
+	free(data);
+	return result;
+}
+
 //TODO: use this when magic_enum starts working with CUDA
 // template <typename E, typename T>
 // void register_enum(T& parent) {
@@ -159,6 +235,8 @@ py::array_t<float> Testbed::screenshot(bool linear) const {
 PYBIND11_MODULE(pyngp, m) {
 	m.doc() = "Instant neural graphics primitives";
 
+	m.def("load_exr", &load_exr_to_cpu, "Loads an EXR image as a (height,width,4) RGBA array. Releases the GIL while decoding.", py::arg("path"));
+
 	py::enum_<ETestbedMode>(m, "TestbedMode")
 		.value("Nerf", ETestbedMode::Nerf)
 		.value("Sdf", ETestbedMode::Sdf)
@@ -236,6 +314,10 @@ PYBIND11_MODULE(pyngp, m) {
 			py::arg("width")=1920, py::arg("height")=1080, py::arg("spp")=1, py::arg("linear")=true,
 			py::arg("start_t")=-1.f, py::arg("end_t")=-1.f,
 			py::arg("fps")=30.f, py::arg("shutter_fraction")=1.0f)
+		.def("render_batch", &Testbed::render_batch_to_cpu, "Renders one image per NeRF-style camera matrix in an (N,3,4) array. Returns an (N,height,width,4) array.",
+			py::arg("camera_matrices"), py::arg("width")=1920, py::arg("height")=1080, py::arg("spp")=1, py::arg("linear")=true)
+		.def("render_batch_into", &Testbed::render_batch_into, "Like render_batch, but writes into a preallocated C-contiguous float32 array of shape (N,height,width,4).",
+			py::arg("out").noconvert(), py::arg("camera_matrices"), py::arg("spp")=1, py::arg("linear")=true)
 		.def("screenshot", &Testbed::screenshot, "Takes a screenshot of the current window contents.", py::arg("linear")=true)
 		// TODO: revisit this binding and return the mesh a python array rather than the number of triangles
 		// .def("marching_cubes", &Testbed::marching_cubes, py::arg("path"), py::arg("res")=128, py::arg("thresh")=2.f, py::arg("unwrap")=false, "Runs marching cubes at the requested res and outputs an OBJ to the given path. Does not require a window.")
@@ -1752,7 +1752,12 @@ void Testbed::train(uint32_t n_training_steps, uint32_t batch_size) {
 			default: throw std::runtime_error{"Invalid training mode."};
 		}
 
-		CUDA_CHECK_THROW(cudaStreamSynchronize(m_training_stream));
+		// Training runs on the same stream as the preparation work, so there is no need to wait
+		// for the latter to finish before enqueuing the training steps. We only synchronize when
+		// the window is open and wants to display how long the preparation took.
+		if (m_render_window) {
+			CUDA_CHECK_THROW(cudaStreamSynchronize(m_training_stream));
+		}
 	}
 
 	// Find leaf optimizer and update its settings